@@ -4,12 +4,20 @@ Uses blocket_api Python package to fetch car listings and stream to Kafka
 """
 
 import json
+import sys
 import time
+import asyncio
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+from dataclasses import asdict, dataclass
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Union
+import numpy as np
 from kafka import KafkaProducer
 from kafka.errors import KafkaError
+from kafka.producer.future import FutureRecordMetadata
 from blocket_api import (
     BlocketAPI,
     CarAd,
@@ -20,6 +28,23 @@ from blocket_api import (
     CarFuelType,
 )
 
+try:
+    import orjson
+
+    _dumps = orjson.dumps
+except ImportError:
+    # Fall back to the standard library if orjson is not installed
+    def _dumps(value) -> bytes:
+        return json.dumps(value, default=asdict).encode('utf-8')
+
+# kafka-python raises AssertionError rather than KafkaError when a
+# compression codec is missing, so only ask for lz4 when it is installed
+try:
+    import lz4.frame  # noqa: F401
+    _COMPRESSION = 'lz4'
+except ImportError:
+    _COMPRESSION = None
+
 # Setup logging
 logging.basicConfig(
     level=logging.INFO,
@@ -27,12 +52,42 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Shared by every listing - interned so all records reference one object
+_SOURCE = sys.intern('blocket')
+_CATEGORY = sys.intern('car')
+_URL_PREFIX = "https://www.blocket.se/"
+
+
+@dataclass(slots=True)
+class Listing:
+    """A car listing parsed from Blocket search results"""
+    listing_id: str
+    title: str
+    price: Optional[int]
+    year: Optional[int]
+    mileage: Optional[int]
+    location: str
+    url: str
+    image_url: Optional[str]
+    scraped_at: str
+    source: str = _SOURCE
+    category: str = _CATEGORY
+    make: Optional[str] = None
+    model: Optional[str] = None
+    fuel_type: Optional[str] = None
+    transmission: Optional[str] = None
+
 
 class BlocketCarScraper:
     """Scraper for Blocket.se used car listings using official API wrapper"""
     
-    def __init__(self):
+    # Optional car-specific attributes, published as null when missing
+    _CAR_ATTRS = ('make', 'model', 'fuel_type', 'transmission')
+    _CAR_DETAIL_ATTRS = _CAR_ATTRS + ('body_type', 'color', 'engine_power')
+    
+    def __init__(self, parse_workers: int = 4):
         self.api = BlocketAPI()
+        self._parse_pool = ThreadPoolExecutor(max_workers=parse_workers)
         logger.info("Initialized Blocket API")
     
     def search_cars(
@@ -47,7 +102,7 @@ class BlocketCarScraper:
         mileage_to: Optional[int] = None,
         sort_order: CarSortOrder = CarSortOrder.PRICE_ASC,
         max_results: int = 100
-    ) -> List[Dict]:
+    ) -> List[Listing]:
         """
         Search for cars with specified criteria
         
@@ -64,7 +119,7 @@ class BlocketCarScraper:
             max_results: Maximum number of results to fetch
         """
         try:
-            logger.info(f"Searching cars: query={query}, locations={locations}")
+            logger.info("Searching cars: query=%s, locations=%s", query, locations)
             
             # Search using the API
             results = self.api.search_car(
@@ -79,128 +134,136 @@ class BlocketCarScraper:
                 sort_order=sort_order,
             )
             
-            # Convert API results to our format
-            listings = []
-            for idx, ad in enumerate(results):
-                if idx >= max_results:
-                    break
-                    
-                try:
-                    listing = self._parse_ad(ad)
-                    if listing:
-                        listings.append(listing)
-                except Exception as e:
-                    logger.error(f"Error parsing ad: {e}")
-                    continue
+            # Convert API results to our format - one timestamp per search
+            now_iso = datetime.utcnow().isoformat()
+            parse = partial(self._parse_ad, now_iso=now_iso)
+            listings = list(filter(None, self._parse_pool.map(parse, islice(results, max_results))))
             
-            logger.info(f"Successfully fetched {len(listings)} car listings")
+            logger.info("Successfully fetched %d car listings", len(listings))
             return listings
             
         except Exception as e:
-            logger.error(f"Error searching cars: {e}")
+            logger.error("Error searching cars: %s", e)
             return []
     
+    async def search_cars_async(self, semaphore: asyncio.Semaphore, **params) -> List[Listing]:
+        """
+        Run search_cars in a worker thread so several searches overlap
+        
+        The blocket_api client is synchronous, so the blocking HTTP call is
+        pushed to the default executor. The semaphore bounds how many
+        requests hit Blocket at once.
+        """
+        async with semaphore:
+            return await asyncio.to_thread(self.search_cars, **params)
+    
     def get_ad_details(self, ad_id: int) -> Optional[Dict]:
         """Fetch detailed information for a specific ad"""
         try:
-            logger.info(f"Fetching details for ad {ad_id}")
+            logger.info("Fetching details for ad %s", ad_id)
             ad_details = self.api.get_ad(CarAd(ad_id))
-            return self._parse_ad_details(ad_details)
+            return self._parse_ad_details(ad_details, datetime.utcnow().isoformat())
         except Exception as e:
-            logger.error(f"Error fetching ad details for {ad_id}: {e}")
+            logger.error("Error fetching ad details for %s: %s", ad_id, e)
             return None
     
-    def _parse_ad(self, ad) -> Optional[Dict]:
-        """Parse ad from search results into standardized format"""
+    def _parse_ad(self, ad, now_iso: str) -> Optional[Listing]:
+        """
+        Parse ad from search results into standardized format
+        
+        Never raises - a malformed ad is logged and skipped so it cannot
+        fail the whole search.
+        """
+        ad_id = getattr(ad, 'ad_id', None)
+        if ad_id is None:
+            return None
+        ad_id = str(ad_id)
+        
+        # Only the nested location/image structures can be malformed - the
+        # other fields are getattr with defaults and price is type-checked
         try:
-            listing = {
-                'listing_id': str(ad.ad_id),
-                'title': getattr(ad, 'subject', 'Unknown'),
-                'price': getattr(ad, 'price', {}).get('value') if hasattr(ad, 'price') else None,
-                'year': getattr(ad, 'year', None),
-                'mileage': getattr(ad, 'mileage', None),
-                'location': self._extract_location(ad),
-                'url': f"https://www.blocket.se/{ad.ad_id}",
-                'image_url': self._extract_image(ad),
-                'scraped_at': datetime.utcnow().isoformat(),
-                'source': 'blocket',
-                'category': 'car'
-            }
-            
-            # Add car-specific fields if available
-            if hasattr(ad, 'make'):
-                listing['make'] = ad.make
-            if hasattr(ad, 'model'):
-                listing['model'] = ad.model
-            if hasattr(ad, 'fuel_type'):
-                listing['fuel_type'] = ad.fuel_type
-            if hasattr(ad, 'transmission'):
-                listing['transmission'] = ad.transmission
-            
-            return listing
-            
-        except Exception as e:
-            logger.error(f"Error parsing ad: {e}")
+            location = self._extract_location(ad)
+            image_url = self._extract_image(ad)
+        except (AttributeError, IndexError, KeyError, TypeError) as e:
+            logger.error("Error parsing ad %s: %s", ad_id, e)
             return None
+        
+        return Listing(
+            listing_id=ad_id,
+            title=getattr(ad, 'subject', 'Unknown'),
+            price=self._extract_price(ad),
+            year=getattr(ad, 'year', None),
+            mileage=getattr(ad, 'mileage', None),
+            location=location,
+            url=_URL_PREFIX + ad_id,
+            image_url=image_url,
+            scraped_at=now_iso,
+            # Car-specific fields, None when not available
+            **{name: getattr(ad, name, None) for name in self._CAR_ATTRS}
+        )
     
-    def _parse_ad_details(self, ad_details) -> Optional[Dict]:
+    def _parse_ad_details(self, ad_details, now_iso: str) -> Optional[Dict]:
         """Parse detailed ad information"""
+        ad_id = getattr(ad_details, 'ad_id', None)
+        if ad_id is None:
+            return None
+        ad_id = str(ad_id)
+        
+        # Only the nested location/image structures can be malformed
         try:
-            details = {
-                'listing_id': str(ad_details.ad_id),
-                'title': getattr(ad_details, 'subject', 'Unknown'),
-                'description': getattr(ad_details, 'body', ''),
-                'price': getattr(ad_details, 'price', {}).get('value') if hasattr(ad_details, 'price') else None,
-                'year': getattr(ad_details, 'year', None),
-                'mileage': getattr(ad_details, 'mileage', None),
-                'location': self._extract_location(ad_details),
-                'url': f"https://www.blocket.se/{ad_details.ad_id}",
-                'images': self._extract_all_images(ad_details),
-                'posted_date': getattr(ad_details, 'list_time', None),
-                'scraped_at': datetime.utcnow().isoformat(),
-                'source': 'blocket',
-                'category': 'car'
-            }
-            
-            # Car-specific details
-            if hasattr(ad_details, 'make'):
-                details['make'] = ad_details.make
-            if hasattr(ad_details, 'model'):
-                details['model'] = ad_details.model
-            if hasattr(ad_details, 'fuel_type'):
-                details['fuel_type'] = ad_details.fuel_type
-            if hasattr(ad_details, 'transmission'):
-                details['transmission'] = ad_details.transmission
-            if hasattr(ad_details, 'body_type'):
-                details['body_type'] = ad_details.body_type
-            if hasattr(ad_details, 'color'):
-                details['color'] = ad_details.color
-            if hasattr(ad_details, 'engine_power'):
-                details['engine_power'] = ad_details.engine_power
-            
-            return details
-            
-        except Exception as e:
-            logger.error(f"Error parsing ad details: {e}")
+            location = self._extract_location(ad_details)
+            images = self._extract_all_images(ad_details)
+        except (AttributeError, KeyError, TypeError) as e:
+            logger.error("Error parsing ad details %s: %s", ad_id, e)
             return None
+        
+        details = {
+            'listing_id': ad_id,
+            'title': getattr(ad_details, 'subject', 'Unknown'),
+            'description': getattr(ad_details, 'body', ''),
+            'price': self._extract_price(ad_details),
+            'year': getattr(ad_details, 'year', None),
+            'mileage': getattr(ad_details, 'mileage', None),
+            'location': location,
+            'url': _URL_PREFIX + ad_id,
+            'images': images,
+            'posted_date': getattr(ad_details, 'list_time', None),
+            'scraped_at': now_iso,
+            'source': _SOURCE,
+            'category': _CATEGORY
+        }
+        
+        # Car-specific details, None when not available - same schema as Listing
+        for name in self._CAR_DETAIL_ATTRS:
+            details[name] = getattr(ad_details, name, None)
+        
+        return details
+    
+    def _extract_price(self, ad) -> Optional[int]:
+        """Extract price value from ad"""
+        price = getattr(ad, 'price', None)
+        return price.get('value') if isinstance(price, dict) else None
     
     def _extract_location(self, ad) -> str:
-        """Extract location from ad"""
-        if hasattr(ad, 'location') and ad.location:
-            return ad.location.get('name', 'Unknown')
+        """Extract location from ad, interned since few distinct names exist"""
+        location = getattr(ad, 'location', None)
+        if location:
+            return sys.intern(location.get('name') or 'Unknown')
         return 'Unknown'
     
     def _extract_image(self, ad) -> Optional[str]:
         """Extract first image URL from ad"""
-        if hasattr(ad, 'images') and ad.images:
-            return ad.images[0].get('url') if ad.images else None
-        return None
+        images = getattr(ad, 'images', None)
+        return images[0].get('url') if images else None
     
     def _extract_all_images(self, ad) -> List[str]:
         """Extract all image URLs from ad"""
-        if hasattr(ad, 'images') and ad.images:
-            return [img.get('url') for img in ad.images if img.get('url')]
-        return []
+        images = getattr(ad, 'images', None) or ()
+        return [url for img in images if (url := img.get('url'))]
+    
+    def close(self):
+        """Shut down the parse worker pool"""
+        self._parse_pool.shutdown()
 
 
 class CarDataKafkaProducer:
@@ -213,60 +276,85 @@ class CarDataKafkaProducer:
         self._connect()
     
     def _connect(self):
-        """Initialize Kafka producer with retry logic"""
-        max_retries = 3
+        """Initialize Kafka producer with exponential backoff retry logic"""
+        max_retries = 5
+        if _COMPRESSION is None:
+            logger.warning("lz4 is not installed - sending Kafka messages uncompressed")
         for attempt in range(max_retries):
             try:
                 self.producer = KafkaProducer(
                     bootstrap_servers=self.bootstrap_servers,
-                    value_serializer=lambda v: json.dumps(v).encode('utf-8'),
                     key_serializer=lambda k: k.encode('utf-8') if k else None,
-                    acks='all',
+                    acks=1,
                     retries=3,
-                    max_in_flight_requests_per_connection=1
+                    linger_ms=50,
+                    batch_size=65536,
+                    compression_type=_COMPRESSION,
+                    max_in_flight_requests_per_connection=5,
+                    request_timeout_ms=10000,
+                    reconnect_backoff_ms=500
                 )
-                logger.info(f"Connected to Kafka at {self.bootstrap_servers}")
+                logger.info("Connected to Kafka at %s", self.bootstrap_servers)
                 return
             except KafkaError as e:
-                logger.error(f"Attempt {attempt + 1}/{max_retries} - Failed to connect to Kafka: {e}")
+                logger.error("Attempt %d/%d - Failed to connect to Kafka: %s", attempt + 1, max_retries, e)
                 if attempt < max_retries - 1:
-                    time.sleep(5)
+                    time.sleep(0.5 * (2 ** attempt))
                 else:
                     raise
     
-    def send_listing(self, listing: Dict) -> bool:
-        """Send a single listing to Kafka"""
+    def send_listing(
+        self,
+        listing: Union[Listing, Dict],
+        payload: Optional[bytes] = None
+    ) -> Optional[FutureRecordMetadata]:
+        """
+        Queue a single listing for sending to Kafka
+        
+        Does not wait for the broker - the producer batches records in the
+        background and failures are logged from the errback. Pass payload
+        to reuse a listing that was already serialized. Accepts both search
+        listings and detail dicts. Returns the send future, or None if the
+        record could not be queued.
+        """
         try:
-            key = listing.get('listing_id', 'unknown')
+            if isinstance(listing, dict):
+                key = listing.get('listing_id', 'unknown')
+            else:
+                key = listing.listing_id
             
             future = self.producer.send(
                 self.topic,
                 key=key,
-                value=listing
+                value=payload if payload is not None else _dumps(listing)
             )
-            
-            record_metadata = future.get(timeout=10)
-            
-            logger.debug(f"Sent listing {key} to {record_metadata.topic} "
-                        f"partition {record_metadata.partition} "
-                        f"offset {record_metadata.offset}")
-            return True
+            future.add_errback(
+                lambda e: logger.error("Failed to send listing %s to Kafka: %s", key, e)
+            )
+            return future
             
         except KafkaError as e:
-            logger.error(f"Failed to send listing to Kafka: {e}")
-            return False
+            logger.error("Failed to send listing to Kafka: %s", e)
+            return None
     
-    def send_batch(self, listings: List[Dict]) -> int:
-        """Send multiple listings to Kafka"""
-        success_count = 0
-        for listing in listings:
-            if self.send_listing(listing):
-                success_count += 1
+    def send_batch(self, listings: List[Union[Listing, Dict]]) -> int:
+        """Send multiple listings to Kafka with a single flush"""
+        futures = [self.send_listing(listing) for listing in listings]
         
         self.producer.flush()
-        logger.info(f"Successfully sent {success_count}/{len(listings)} listings to Kafka")
+        success_count = self.count_delivered(futures)
+        logger.info("Successfully sent %d/%d listings to Kafka", success_count, len(listings))
         return success_count
     
+    @staticmethod
+    def count_delivered(futures: List[Optional[FutureRecordMetadata]]) -> int:
+        """Count send futures that completed successfully - call after flush"""
+        return sum(1 for f in futures if f is not None and f.succeeded())
+    
+    def flush(self):
+        """Block until all queued listings have been sent"""
+        self.producer.flush()
+    
     def close(self):
         """Close the producer"""
         if self.producer:
@@ -274,7 +362,43 @@ class CarDataKafkaProducer:
             logger.info("Kafka producer closed")
 
 
-def main():
+# Search for cars - multiple searches to capture different segments
+SEARCH_CONFIGS = [
+    {
+        'name': 'All Stockholm Cars',
+        'locations': [Location.STOCKHOLM],
+        'sort_order': CarSortOrder.LATEST,
+        'max_results': 50
+    },
+    {
+        'name': 'Potential Classics (15-30 years old)',
+        'locations': [Location.STOCKHOLM, Location.UPPSALA, Location.GOTEBORG],
+        'year_from': 1995,
+        'year_to': 2010,
+        'sort_order': CarSortOrder.PRICE_ASC,
+        'max_results': 100
+    },
+    {
+        'name': 'Budget Cars Under 50k',
+        'locations': [Location.STOCKHOLM],
+        'price_to': 50000,
+        'sort_order': CarSortOrder.PRICE_ASC,
+        'max_results': 50
+    },
+]
+
+# Call-ready (name, max_results, search params) for each config, built once
+_PREPARED_SEARCHES = [
+    (
+        config['name'],
+        config.get('max_results', 50),
+        {k: v for k, v in config.items() if k not in ('name', 'max_results')},
+    )
+    for config in SEARCH_CONFIGS
+]
+
+
+async def main():
     """Main scraping pipeline"""
     logger.info("Starting Swedish car price scraper")
     
@@ -288,76 +412,104 @@ def main():
             topic='raw-car-listings'
         )
     except Exception as e:
-        logger.error(f"Could not initialize Kafka producer: {e}")
+        logger.error("Could not initialize Kafka producer: %s", e)
         logger.info("Running in dry-run mode (no Kafka)")
         kafka_producer = None
     
-    # Search for cars - multiple searches to capture different segments
-    search_configs = [
-        {
-            'name': 'All Stockholm Cars',
-            'locations': [Location.STOCKHOLM],
-            'sort_order': CarSortOrder.LATEST,
-            'max_results': 50
-        },
-        {
-            'name': 'Potential Classics (15-30 years old)',
-            'locations': [Location.STOCKHOLM, Location.UPPSALA, Location.GOTEBORG],
-            'year_from': 1995,
-            'year_to': 2010,
-            'sort_order': CarSortOrder.PRICE_ASC,
-            'max_results': 100
-        },
-        {
-            'name': 'Budget Cars Under 50k',
-            'locations': [Location.STOCKHOLM],
-            'price_to': 50000,
-            'sort_order': CarSortOrder.PRICE_ASC,
-            'max_results': 50
-        },
-    ]
+    # Scrapers feed a bounded queue that a single publisher drains, so
+    # fetching, parsing and producing to Kafka overlap
+    queue: asyncio.Queue = asyncio.Queue(maxsize=1000)
+    semaphore = asyncio.Semaphore(5)
+    prices: List[int] = []
+    years: List[int] = []
+    # The searches overlap, so skip listings another search already found
+    seen_ids: set[str] = set()
     
-    all_listings = []
-    
-    for config in search_configs:
-        logger.info(f"Running search: {config['name']}")
-        
-        # Extract search params
-        search_params = {k: v for k, v in config.items() if k not in ['name', 'max_results']}
-        max_results = config.get('max_results', 50)
+    async def scrape(name: str, max_results: int, search_params: Dict):
+        listings = await scraper.search_cars_async(
+            semaphore, **search_params, max_results=max_results
+        )
+        found = len(listings)
+        # No await between the check and the update, so tasks can't race
+        listings = [l for l in listings if l.listing_id not in seen_ids]
+        seen_ids.update(l.listing_id for l in listings)
+        logger.info("Search finished: %s (%d listings, %d new)",
+                    name, found, len(listings))
         
-        listings = scraper.search_cars(**search_params, max_results=max_results)
+        if not kafka_producer:
+            logger.info("DRY RUN - Would send %d listings to Kafka", len(listings))
+            for listing in listings[:3]:  # Show first 3
+                logger.info("Sample: %s - %s SEK (%s)", listing.title, listing.price, listing.year)
         
-        if listings:
-            all_listings.extend(listings)
+        # Serialize in a worker thread so the publisher only hands bytes
+        # to the Kafka producer
+        payloads = (
+            await asyncio.to_thread(lambda: [_dumps(l) for l in listings])
+            if kafka_producer else [None] * len(listings)
+        )
+        for item in zip(listings, payloads):
+            await queue.put(item)
+    
+    async def publish() -> int:
+        count = 0
+        futures = []
+        done = False
+        while not done:
+            # Take everything already queued so each thread hop sends a batch
+            batch = []
+            item = await queue.get()
+            while item is not None:
+                batch.append(item)
+                if queue.empty():
+                    break
+                item = queue.get_nowait()
+            done = item is None
             
-            # Stream to Kafka
-            if kafka_producer:
-                kafka_producer.send_batch(listings)
-            else:
-                logger.info(f"DRY RUN - Would send {len(listings)} listings to Kafka")
-                for listing in listings[:3]:  # Show first 3
-                    logger.info(f"Sample: {listing['title']} - {listing['price']} SEK ({listing['year']})")
+            count += len(batch)
+            for listing, _ in batch:
+                if listing.price:
+                    prices.append(listing.price)
+                if listing.year:
+                    years.append(listing.year)
+            
+            # Stream to Kafka - producer.send can block on metadata or a
+            # full buffer, so keep it off the event loop
+            if kafka_producer and batch:
+                futures.extend(await asyncio.to_thread(
+                    lambda: [kafka_producer.send_listing(l, p) for l, p in batch]
+                ))
         
-        # Be respectful with delays
-        time.sleep(2)
+        if kafka_producer:
+            await asyncio.to_thread(kafka_producer.flush)
+            logger.info("Successfully sent %d/%d listings to Kafka",
+                        kafka_producer.count_delivered(futures), count)
+        return count
     
-    logger.info(f"Scraping complete. Total listings collected: {len(all_listings)}")
+    async with asyncio.TaskGroup() as pipeline:
+        publisher = pipeline.create_task(publish())
+        async with asyncio.TaskGroup() as scrapers:
+            for name, max_results, search_params in _PREPARED_SEARCHES:
+                scrapers.create_task(scrape(name, max_results, search_params))
+        # All searches are done - tell the publisher to stop
+        await queue.put(None)
+    
+    logger.info("Scraping complete. Total listings collected: %d", publisher.result())
     
     # Show some statistics
-    if all_listings:
-        avg_price = sum(l['price'] for l in all_listings if l.get('price')) / len([l for l in all_listings if l.get('price')])
-        logger.info(f"Average price: {avg_price:.0f} SEK")
-        
-        years = [l['year'] for l in all_listings if l.get('year')]
-        if years:
-            logger.info(f"Year range: {min(years)} - {max(years)}")
+    prices = np.fromiter(prices, dtype=np.int64, count=len(prices))
+    years = np.fromiter(years, dtype=np.int64, count=len(years))
+    
+    if prices.size:
+        logger.info("Average price: %.0f SEK", prices.mean())
+    if years.size:
+        logger.info("Year range: %d - %d", years.min(), years.max())
     
     # Cleanup
+    scraper.close()
     if kafka_producer:
         kafka_producer.close()
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
     
\ No newline at end of file